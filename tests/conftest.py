@@ -0,0 +1,12 @@
+# Third party modules
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_home(monkeypatch, tmpdir):
+    """
+    Keep compiled templates and version branch clones out of
+    the user's real cache directory (~/.cache/documentation-builder)
+    """
+
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
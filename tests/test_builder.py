@@ -138,6 +138,62 @@ def test_basic_build():
     rmtree(output)
 
 
+def test_unchanged_files():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base')
+    output = path.join(fixtures, 'output')
+    index = path.join(fixtures, 'output', 'en', 'index.html')
+    if path.exists(output):
+        rmtree(output)
+
+    Builder(
+        base_directory=base,
+        output_path=output,
+        quiet=True
+    )
+
+    # Make the built file look out of date, without changing the source
+    utime(index, (0, 0))
+
+    mock_out = StringIO()
+    Builder(
+        base_directory=base,
+        output_path=output,
+        out=mock_out
+    )
+
+    # Check it was skipped, and marked as up to date
+    assert 'Skipping unchanged files' in mock_out.getvalue()
+    assert path.getmtime(index) > 0
+
+    # Hashes are kept with the built files
+    assert path.isfile(path.join(output, '.build-cache.json')) is True
+
+    rmtree(output)
+
+
+def test_single_worker():
+    fixtures = path.join(fixtures_base, 'builder')
+    base = path.join(fixtures, 'base')
+    output = path.join(fixtures, 'output')
+    expected_output = path.join(fixtures, 'output_basic')
+    if path.exists(output):
+        rmtree(output)
+
+    # Build without a process pool
+    Builder(
+        base_directory=base,
+        output_path=output,
+        workers=1,
+        quiet=True
+    )
+
+    _compare_trees(output, expected_output)
+    _compare_html_parts(output, expected_output)
+
+    rmtree(output)
+
+
 def test_no_media():
     fixtures = path.join(fixtures_base, 'builder')
     base = path.join(fixtures, 'base-no-media')
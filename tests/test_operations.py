@@ -1,34 +1,43 @@
 # Core modules
 from copy import deepcopy
-from os import path, utime
+from os import chdir, getcwd, path, scandir, utime
 from shutil import rmtree
 
 # Third party modules
 import yaml
 import markdown
 import pytest
+from mock import call, patch
 from git import Repo
 from git.exc import GitCommandError, InvalidGitRepositoryError
 from jinja2 import Template
 
 # Local modules
 from ubuntudesign.documentation_builder.operations import (
+    build_hash,
     compile_metadata,
     convert_path_to_html,
     copy_media,
     find_files,
     find_metadata,
+    load_template,
     parse_markdown,
     prepare_version_branches,
+    read_build_hashes,
     relativize_paths,
     replace_internal_links,
+    replace_links,
     replace_media_links,
     set_active_navigation_items,
     version_paths,
+    write_build_hashes,
     write_html
 )
 from ubuntudesign.documentation_builder.builder import markdown_extensions
-from ubuntudesign.documentation_builder.utilities import cache_dir
+from ubuntudesign.documentation_builder.utilities import (
+    cache_dir,
+    scan_files
+)
 
 
 example_dictionary = {
@@ -50,6 +59,43 @@ example_dictionary = {
 fixtures_path = path.join(path.dirname(__file__), 'fixtures')
 
 
+def test_build_hash(monkeypatch, tmpdir):
+    markdown_file = tmpdir.join('file.md')
+    markdown_file.write('# Title')
+    filepath = str(markdown_file)
+    options = ({'title': 'Title'}, 'file.html')
+
+    file_hash = build_hash(filepath, '{{ content }}', options)
+
+    assert build_hash(filepath, '{{ content }}', options) == file_hash
+    assert build_hash(filepath, '<p>{{ content }}</p>', options) != file_hash
+
+    # A new version of the builder may render files differently
+    monkeypatch.setattr(
+        'ubuntudesign.documentation_builder.operations.__version__',
+        '0.0.0'
+    )
+    assert build_hash(filepath, '{{ content }}', options) != file_hash
+
+
+def test_build_hashes(tmpdir):
+    hashes_path = str(tmpdir.join('.build-cache.json'))
+
+    # Missing hashes just mean nothing has been built
+    assert read_build_hashes(hashes_path) == {}
+
+    assert write_build_hashes({'index.html': 'abc'}, hashes_path) is True
+    assert read_build_hashes(hashes_path) == {'index.html': 'abc'}
+
+    # Corrupt hashes are ignored
+    tmpdir.join('.build-cache.json').write('{"index.html"')
+    assert read_build_hashes(hashes_path) == {}
+
+    # Failing to save hashes isn't an error
+    missing_path = str(tmpdir.join('missing', '.build-cache.json'))
+    assert write_build_hashes({'index.html': 'abc'}, missing_path) is False
+
+
 def test_compile_metadata():
     metadata_items = {
         '.': {
@@ -85,6 +131,12 @@ def test_compile_metadata():
                     }
                 ]
             }
+        },
+        'child..old': {
+            'content': {'site_title': 'old child title'}
+        },
+        '-extra': {
+            'content': {'site_title': 'extra title'}
         }
     }
 
@@ -138,6 +190,15 @@ def test_compile_metadata():
     assert grandchild_metadata == expected_grandchild_metadata
     assert grandchild2_metadata == expected_grandchild2_metadata
 
+    # Directory names containing ".." are matched like any other
+    old_child_metadata = compile_metadata(metadata_items, 'child..old')
+    assert old_child_metadata == {'site_title': 'old child title'}
+
+    # Parent metadata is applied before child metadata,
+    # even where the child's name sorts before "."
+    extra_metadata = compile_metadata(metadata_items, '-extra')
+    assert extra_metadata == {'site_title': 'extra title'}
+
 
 def test_copy_media():
     source_path = path.join(fixtures_path, 'copy_media', 'source_dir')
@@ -176,6 +237,16 @@ def test_copy_media():
         path.join(output_path, 'subfolder', 'medium2.png')
     ) is True
 
+    # A newer destination file with a different size is still replaced
+    output_file_path = path.join(output_path, 'medium.png')
+    with open(output_file_path, 'w') as output_file:
+        output_file.write('edited')
+    future_time = path.getmtime(output_file_path) + 3600
+    utime(output_file_path, (future_time, future_time))
+
+    assert copy_media(source_path, output_path) is True
+    assert path.getsize(output_file_path) == 0
+
 
 def test_find_files():
     source_dir = path.join(fixtures_path, 'find_files', 'source_dir')
@@ -287,6 +358,44 @@ def test_find_metadata():
         find_metadata(empty_dir)
 
 
+def test_load_template():
+    template_path = path.join(
+        fixtures_path, 'parse_markdown', 'template.jinja2'
+    )
+
+    template_source, template = load_template(template_path)
+
+    with open(template_path, encoding="utf-8") as template_file:
+        assert template_source == template_file.read()
+
+    # Unmodified templates are reused
+    assert load_template(template_path)[1] is template
+
+    # Modified templates are compiled again
+    modified_time = path.getmtime(template_path) + 1
+    utime(template_path, (modified_time, modified_time))
+    assert load_template(template_path)[1] is not template
+
+
+def test_load_template_without_cache(monkeypatch, tmpdir):
+    template_path = path.join(
+        fixtures_path, 'parse_markdown', 'template.jinja2'
+    )
+
+    # A cache directory which can't be created shouldn't stop templates
+    # being compiled, they just aren't cached on disk
+    not_a_directory = tmpdir.join('not-a-directory')
+    not_a_directory.write('')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(not_a_directory))
+
+    # Change the modified time, so the template is compiled again
+    modified_time = path.getmtime(template_path) + 1
+    utime(template_path, (modified_time, modified_time))
+    template = load_template(template_path)[1]
+
+    assert '<main>Hello</main>' in template.render(content='Hello')
+
+
 def test_parse_markdown():
     function_fixtures = path.join(fixtures_path, 'parse_markdown')
     metadata_path = path.join(function_fixtures, 'metadata.yaml')
@@ -296,8 +405,8 @@ def test_parse_markdown():
     )
     mmdata_path = path.join(function_fixtures, 'metadata_markdown_mmdata.md')
     plain_path = path.join(function_fixtures, 'plain_markdown.md')
-    # The "error" file tries to trigger an error with the frontmatter parser,
-    # which should be handled gracefully
+    # The "error" file has "---" headings but no frontmatter block,
+    # so it should be parsed as plain markdown
     plain_error_path = path.join(function_fixtures, 'plain_markdown_error.md')
     plain_output_path = path.join(function_fixtures, 'plain_markdown.html')
     metadata_output_path = path.join(
@@ -332,6 +441,41 @@ def test_parse_markdown():
         assert mmdata_html == expected_metadata_html
 
 
+def test_parse_markdown_horizontal_rules():
+    function_fixtures = path.join(fixtures_path, 'parse_markdown')
+    rules_path = path.join(function_fixtures, 'horizontal_rules.md')
+    template_path = path.join(function_fixtures, 'template.jinja2')
+
+    parser = markdown.Markdown(markdown_extensions)
+    with open(template_path, encoding="utf-8") as template_file:
+        template = Template(template_file.read())
+
+    # Without frontmatter, "---" lines are rules, and no text is lost
+    html = parse_markdown(parser, template, rules_path, {})
+
+    assert 'Introduction paragraph.' in html
+    assert 'Note: a paragraph between rules' in html
+    assert 'Closing paragraph.' in html
+    assert html.count('<hr') == 2
+
+
+def test_parse_markdown_invalid_frontmatter():
+    function_fixtures = path.join(fixtures_path, 'parse_markdown')
+    invalid_path = path.join(function_fixtures, 'invalid_frontmatter.md')
+    template_path = path.join(function_fixtures, 'template.jinja2')
+
+    parser = markdown.Markdown(markdown_extensions)
+    with open(template_path, encoding="utf-8") as template_file:
+        template = Template(template_file.read())
+
+    # Starting with "---" followed by invalid YAML shouldn't raise,
+    # the whole file should be rendered as markdown instead
+    html = parse_markdown(parser, template, invalid_path, {})
+
+    assert 'Note: mapping values: are not allowed here' in html
+    assert 'Paragraph after the rules.' in html
+
+
 def test_prepare_version_branches():
     repo_path = path.join(fixtures_path, 'prepare_version_branches', 'repo')
     not_repo = path.join(fixtures_path, 'prepare_version_branches', 'not_repo')
@@ -514,6 +658,40 @@ def test_replace_internal_links():
     assert output_no_extensions == expected_output_no_extensions
 
 
+def test_replace_links():
+    html = (
+        '<a href="page1.md#section">page1.md</a>\n'
+        '<a href="/index.md">index.md</a>\n'
+        '<a href="http://example.com/index.md">index.md</a>\n'
+        '<img src="../media/image.png" alt="../media/image.png">\n'
+        '<a href="../media/notes.md">notes</a>\n'
+    )
+
+    # Media and internal links are both replaced
+    output = replace_links(html, 'media', 'static', 'en')
+    expected_output = (
+        '<a href="page1.html#section">page1.md</a>\n'
+        '<a href="/index.md">index.md</a>\n'
+        '<a href="http://example.com/index.md">index.md</a>\n'
+        '<img src="../static/image.png" alt="../media/image.png">\n'
+        '<a href="../static/notes.html">notes</a>\n'
+    )
+    assert output == expected_output
+
+    # Internal links can be left alone
+    output_media_only = replace_links(
+        html, 'media', '/static', 'en', link_extension=None
+    )
+    expected_output_media_only = (
+        '<a href="page1.md#section">page1.md</a>\n'
+        '<a href="/index.md">index.md</a>\n'
+        '<a href="http://example.com/index.md">index.md</a>\n'
+        '<img src="/static/image.png" alt="../media/image.png">\n'
+        '<a href="/static/notes.md">notes</a>\n'
+    )
+    assert output_media_only == expected_output_media_only
+
+
 def test_replace_media_links():
     html = (
         '\n\n<a href="/media/thing.png">some ../media</a>\n'
@@ -537,6 +715,54 @@ def test_replace_media_links():
     assert output_absolute == expected_output_absolute
 
 
+def test_scan_files(monkeypatch):
+    scan_dir = path.join(fixtures_path, 'scan_files')
+    source_dir = path.join(scan_dir, 'source_dir')
+
+    # Finds files by extension or name, skipping hidden files and folders
+    markdown_files = list(scan_files(source_dir, extension='.md'))
+    metadata_files = list(scan_files(source_dir, filename='metadata.yaml'))
+
+    assert markdown_files == [
+        path.join(source_dir, 'index.md'),
+        path.join(source_dir, 'subfolder', 'page.md')
+    ]
+    assert metadata_files == [
+        path.join(source_dir, 'metadata.yaml'),
+        path.join(source_dir, 'subfolder', 'metadata.yaml')
+    ]
+
+    # Paths in the current directory have no "./" prefix, like glob
+    original_dir = getcwd()
+    chdir(source_dir)
+    try:
+        assert list(scan_files('.', extension='.md')) == [
+            'index.md',
+            path.join('subfolder', 'page.md')
+        ]
+    finally:
+        chdir(original_dir)
+
+    # A missing directory has no files
+    assert list(scan_files(path.join(scan_dir, 'missing'))) == []
+
+    # Like glob, directories which can't be read are skipped
+    def scandir_except_subfolder(directory):
+        if path.basename(directory) == 'subfolder':
+            raise PermissionError(directory)
+
+        return scandir(directory)
+
+    monkeypatch.setattr(
+        'ubuntudesign.documentation_builder.utilities.scandir',
+        scandir_except_subfolder
+    )
+
+    assert list(scan_files(source_dir, extension='.md')) == [
+        path.join(source_dir, 'index.md')
+    ]
+
+
 def test_set_active_navigation_items():
     navigation_items = [
         {
@@ -663,5 +889,17 @@ def test_write_html():
     with open(html_filepath, encoding="utf-8") as html_file:
         assert html_file.read() == html_content
 
+    # Writing the same content again only updates the modified time
+    utime(html_filepath, (0, 0))
+    with patch('builtins.open', wraps=open) as mock_open:
+        write_html(html_content, md_filepath)
+    assert call(html_filepath, mode="wb") not in mock_open.call_args_list
+    assert path.getmtime(html_filepath) > 0
+
+    # Different content is written out
+    write_html(html_content + "\n", md_filepath)
+    with open(html_filepath, encoding="utf-8") as html_file:
+        assert html_file.read() == html_content + "\n"
+
     # Delete it again
     rmtree(html_dir)
@@ -1,10 +1,11 @@
 # Core modules
 import sys
-from os import path
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from os import cpu_count, path, utime
 
 # Third party modules
 import markdown
-from jinja2 import Template
 from markdown.extensions.attr_list import AttrListExtension
 from markdown.extensions.def_list import DefListExtension
 from markdown.extensions.fenced_code import FencedCodeExtension
@@ -17,16 +18,19 @@ from mdx_foldouts import makeExtension as FoldoutsExtension
 
 # Local modules
 from .operations import (
+    build_hash,
     compile_metadata,
     copy_media,
     find_files,
     find_metadata,
-    replace_internal_links,
-    replace_media_links,
+    load_template,
+    replace_links,
     parse_markdown,
     prepare_version_branches,
+    read_build_hashes,
     set_active_navigation_items,
     version_paths,
+    write_build_hashes,
     write_html,
     convert_path_to_html
 )
@@ -52,6 +56,60 @@ markdown_extensions = [
     FoldoutsExtension(),
 ]
 
+# The parser and template belonging to this worker process
+worker_state = {}
+
+
+def build_file(
+    parser,
+    template,
+    filepath,
+    metadata,
+    output_filepath,
+    old_media_path,
+    new_media_path,
+    context_directory,
+    link_extensions
+):
+    """
+    Build a single markdown file into an HTML file
+    """
+
+    html = parse_markdown(parser, template, filepath, metadata)
+
+    html = replace_links(
+        html,
+        old_media_path=old_media_path,
+        new_media_path=new_media_path,
+        context_directory=context_directory,
+        link_extension='.html' if link_extensions else ''
+    )
+
+    return write_html(html, output_filepath)
+
+
+def build_file_in_worker(job):
+    """
+    Build a file inside a worker process.
+    The parser and template can't be pickled, so each worker
+    creates its own on first use and reuses them from then on.
+    """
+
+    template_path, arguments = job
+
+    if worker_state.get('template_path') != template_path:
+        worker_state['template'] = load_template(template_path)[1]
+        worker_state['parser'] = markdown.Markdown(
+            extensions=markdown_extensions
+        )
+        worker_state['template_path'] = template_path
+
+    return build_file(
+        worker_state['parser'],
+        worker_state['template'],
+        *arguments
+    )
+
 
 class Builder():
     def __init__(
@@ -72,6 +130,7 @@ class Builder():
         tag_manager_code=None,
         no_link_extensions=False,
         no_cleanup=False,
+        workers=None,
         quiet=False,
         out=sys.stdout,
         err=sys.stderr,
@@ -91,9 +150,10 @@ class Builder():
         self.search_placeholder = search_placeholder
         self.search_domains = search_domains
         self.no_link_extensions = no_link_extensions
+        self.workers = workers or cpu_count() or 1
+        self.template_path = template_path
         self.parser = markdown.Markdown(extensions=markdown_extensions)
-        with open(template_path, encoding="utf-8") as template_file:
-            self.template = Template(template_file.read())
+        self.template_source, self.template = load_template(template_path)
         self.output_media_path = output_media_path or path.join(
             output_path, 'media'
         )
@@ -200,18 +260,53 @@ class Builder():
                 )
             )
 
+        # Hashes of the inputs each file was last built from,
+        # kept with the built files. Forget any files no longer in the source
+        build_hashes_path = path.join(output_path, '.build-cache.json')
+        output_files = set(
+            path.relpath(filepath, source_path)[:-3] + '.html'
+            for filepath in files[0] + files[1] + files[2]
+        )
+        build_hashes = {
+            output_file: file_hash
+            for output_file, file_hash
+            in read_build_hashes(build_hashes_path).items()
+            if output_file in output_files
+        }
+
         built_files = []
+        unchanged_files = []
+        jobs = []
+        job_hashes = {}
+
+        # Media locations are the same for every file in the branch
+        relative_media_path = path.relpath(
+            self.media_path,
+            path.join(self.base_directory, self.source_folder)
+        )
+        new_media_path = self.media_url or path.relpath(
+            self.output_media_path,
+            output_path
+        )
+
+        # Files in the same directory share the same compiled metadata
+        directory_metadata = {}
 
-        # Create output files
+        # Prepare the metadata for each output file
         for filepath in parse_files:
             relative_filepath = path.relpath(filepath, source_path)
             file_directory = path.normpath(path.dirname(filepath))
             relative_directory = path.dirname(relative_filepath)
+            metadata_directory = path.relpath(file_directory, source_path)
 
-            metadata = compile_metadata(
-                metadata_items,
-                path.relpath(file_directory, source_path)
-            )
+            if metadata_directory not in directory_metadata:
+                directory_metadata[metadata_directory] = compile_metadata(
+                    metadata_items,
+                    metadata_directory
+                )
+
+            # Copy, as navigation items are marked active per file
+            metadata = deepcopy(directory_metadata[metadata_directory])
             metadata['site_root'] = self.site_root
             metadata['tag_manager_code'] = self.tag_manager_code
             metadata['search_url'] = self.search_url
@@ -243,38 +338,71 @@ class Builder():
             else:
                 metadata['base_canonical'] = convert_path_to_html(filepath)
 
-            html = parse_markdown(
-                self.parser,
-                self.template,
+            job = (
                 filepath,
-                metadata
+                metadata,
+                path.join(output_path, relative_filepath),
+                relative_media_path,
+                new_media_path,
+                relative_directory,
+                not self.no_link_extensions
             )
 
-            relative_media_path = path.relpath(
-                self.media_path,
-                path.join(self.base_directory, self.source_folder)
-            )
-            relative_output_media_path = path.relpath(
-                self.output_media_path,
-                output_path
+            # Skip files whose inputs haven't changed since they were
+            # last built, even if their modification times have
+            # (e.g. in freshly cloned version branches)
+            relative_html_filepath = relative_filepath[:-3] + '.html'
+            html_filepath = path.join(output_path, relative_html_filepath)
+            job_hash = build_hash(filepath, self.template_source, job[1:])
+
+            if (
+                not self.force and
+                job_hash and
+                build_hashes.get(relative_html_filepath) == job_hash and
+                path.isfile(html_filepath)
+            ):
+                # Mark as up to date, so find_files skips it next time
+                utime(html_filepath)
+                unchanged_files.append(filepath)
+                continue
+
+            # Forget the old hash until the file is rebuilt, in case
+            # the build fails after the file has been overwritten
+            build_hashes.pop(relative_html_filepath, None)
+            job_hashes[relative_html_filepath] = job_hash
+            jobs.append(job)
+
+        if unchanged_files:
+            self._print(
+                'Skipping unchanged files:\n- {}'.format(
+                    '\n- '.join(unchanged_files)
+                )
             )
 
-            html = replace_media_links(
-                html,
-                old_path=relative_media_path,
-                new_path=self.media_url or relative_output_media_path,
-                context_directory=relative_directory
-            )
+        if jobs:
+            write_build_hashes(build_hashes, build_hashes_path)
 
-            html = replace_internal_links(
-                html,
-                extensions=(not self.no_link_extensions)
-            )
+        if self.workers > 1 and len(jobs) > 1:
+            # Markdown parsing is CPU bound, so spread it across processes.
+            # Workers all start up front, so don't start more than needed
+            workers = min(self.workers, len(jobs))
 
-            output_filepath = path.join(output_path, relative_filepath)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                built_files = list(
+                    executor.map(
+                        build_file_in_worker,
+                        [(self.template_path, job) for job in jobs],
+                        chunksize=8
+                    )
+                )
+        else:
+            for job in jobs:
+                built_files.append(
+                    build_file(self.parser, self.template, *job)
+                )
 
-            built_filepath = write_html(html, output_filepath)
-            built_files.append(built_filepath)
+        build_hashes.update(job_hashes)
+        write_build_hashes(build_hashes, build_hashes_path)
 
         return built_files
 
@@ -127,6 +127,14 @@ def parse_arguments(arguments):
         action='store_true',
         help="Don't clean up temporary directory after cloning repository"
     )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help=(
+            "The number of processes to build files with "
+            "(defaults to the number of CPUs)"
+        )
+    )
     parser.add_argument(
         '--quiet',
         action='store_true',
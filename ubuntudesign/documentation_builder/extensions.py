@@ -75,6 +75,24 @@ class NotificationsExtension(Extension):
 class NotificationsProcessor(BlockProcessor):
 
     line_match = re.compile(r'(?:^|\n)!!!\ ?([\w\-]+)(?:\ "(.*?)")?')
+    template = jinja2.Template(
+        '<div class="{{ class }}">' +
+        '  <p class="p-notification__response">' +
+        '    {% if title %}' +
+        '      <span class="p-notification__status">' +
+        '        {{ title }}:' +
+        '      </span>' +
+        '    {% endif %}' +
+        '    <span class="p-notification__line">{{body}}</span>' +
+        '  </p>' +
+        '</div>'
+    )
+    type_classes = {
+        'warning': 'p-notification--caution',
+        'positive': 'p-notification--positive',
+        'negative': 'p-notification--negative',
+        'information': 'p-notification--information',
+    }
 
     def test(self, parent, block):
         sibling = self.lastChild(parent)
@@ -100,30 +118,11 @@ class NotificationsProcessor(BlockProcessor):
         contents = block.replace('\n', ' ').replace('\r', '').strip()
 
         if match:
-            template = jinja2.Template(
-                '<div class="{{ class }}">' +
-                '  <p class="p-notification__response">' +
-                '    {% if title %}' +
-                '      <span class="p-notification__status">' +
-                '        {{ title }}:' +
-                '      </span>' +
-                '    {% endif %}' +
-                '    <span class="p-notification__line">{{body}}</span>' +
-                '  </p>' +
-                '</div>'
-            )
             notification_type, title = self.get_type_and_title(match)
 
-            type_classes = {
-                'warning': 'p-notification--caution',
-                'positive': 'p-notification--positive',
-                'negative': 'p-notification--negative',
-                'information': 'p-notification--information',
-            }
-
-            markup = template.render(
+            markup = self.template.render(
                 {
-                    'class': type_classes.get(
+                    'class': self.type_classes.get(
                         notification_type,
                         'p-notification'
                     ),
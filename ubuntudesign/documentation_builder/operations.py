@@ -1,32 +1,85 @@
 # Core modules
+import hashlib
+import json
 import re
 import tempfile
-from collections import Mapping
+from collections.abc import Mapping
 from copy import deepcopy
-from glob import glob, iglob
-from os import makedirs, path
+from functools import lru_cache
+from os import W_OK, access, makedirs, path, replace, utime
 
 # Third party modules
 import frontmatter
 import yaml
 from bs4 import BeautifulSoup
-from git import Repo
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from yaml.scanner import ScannerError
 from yaml.parser import ParserError
 from xml.etree.ElementTree import ParseError
+try:
+    # Prefer the libyaml C parser, where PyYAML was built with it
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 # Local modules
+from . import __version__
 from .utilities import (
     cache_dir,
     matching_metadata,
     mergetree,
     relativize,
-    replace_link_paths
+    scan_files
 )
 
 
+# Patterns
+non_word_match = re.compile(r'\W+')
+markdown_location_match = re.compile(r'^[^ "\']+.md(#|\?|$)')
+# The value of each src or href attribute. The single-character
+# lookbehind runs first, so most positions are rejected cheaply
+link_value_match = re.compile(
+    r'(?<=["\'])(?:(?<=src=["\'])|(?<=href=["\']))[^"\']+'
+)
+# A local link to a .md file, at the start of an attribute value
+internal_link_match = re.compile(r'((?:[^ "\'/]|(?<=[^/"\'])/)+)\.md\b')
+
+
+def build_hash(filepath, template_source, options):
+    """
+    Hash everything that goes into building a file:
+    the markdown source, the template, the options passed to it
+    and the version of the builder doing the rendering.
+    Returns None if the options can't be serialised consistently.
+    """
+
+    try:
+        options_json = json.dumps(options, sort_keys=True, default=str)
+    except TypeError:
+        # E.g. a mixture of string and number keys can't be sorted
+        return None
+
+    file_hash = hashlib.sha1()
+
+    with open(filepath, 'rb') as markdown_file:
+        file_hash.update(markdown_file.read())
+
+    file_hash.update(template_source.encode('utf-8'))
+    file_hash.update(options_json.encode('utf-8'))
+    file_hash.update(__version__.encode('utf-8'))
+
+    return file_hash.hexdigest()
+
+
 def compile_metadata(metadata_items, context_path):
     metadata = {}
 
+    # matching_metadata expects normalised keys, but callers
+    # may pass keys like "./child", so normalise them first
+    metadata_items = {
+        path.normpath(dirpath): item
+        for dirpath, item in metadata_items.items()
+    }
+
     for dirpath, item in matching_metadata(metadata_items, context_path):
         metadata_tree = deepcopy(item['content'])
         metadata_tree = relativize_paths(
@@ -66,35 +119,44 @@ def find_files(source_path, output_path, metadata_items):
     modified_files = []
     unmodified_files = []
 
-    for filepath in iglob(
-        path.normpath(path.join(source_path, '**/*.md')),
-        recursive=True
-    ):
+    # The newest metadata affecting each directory
+    metadata_modified_times = {}
+
+    for filepath in scan_files(source_path, extension='.md'):
         local_filepath = path.relpath(filepath, source_path)
         local_dir = path.normpath(path.dirname(local_filepath))
-        filename = path.basename(filepath)
-        name = path.splitext(filename)[0]
 
+        # Every match ends in ".md", so swap the suffix directly
+        name = path.basename(local_filepath)[:-3]
         output_filepath = path.join(
             output_path,
-            path.join(local_dir, name)
-        ) + '.html'
+            local_filepath[:-3] + '.html'
+        )
 
-        if re.sub(r'\W+', '', name).isupper():
+        if non_word_match.sub('', name).isupper():
             uppercase_files.append(filepath)
         elif not path.isfile(output_filepath):
             new_files.append(filepath)
         else:
-            metadata_modified = 0
+            if local_dir not in metadata_modified_times:
+                metadata_modified = 0
 
-            for dirpath, item in matching_metadata(metadata_items, local_dir):
-                metadata_modified = max(
-                    metadata_modified,
-                    item['modified']
-                )
+                for dirpath, item in matching_metadata(
+                    metadata_items,
+                    local_dir
+                ):
+                    metadata_modified = max(
+                        metadata_modified,
+                        item['modified']
+                    )
+
+                metadata_modified_times[local_dir] = metadata_modified
 
             # Check if the file is modified
-            modified = max(metadata_modified, path.getmtime(filepath))
+            modified = max(
+                metadata_modified_times[local_dir],
+                path.getmtime(filepath)
+            )
             if path.getmtime(output_filepath) < modified:
                 modified_files.append(filepath)
             else:
@@ -118,10 +180,7 @@ def find_metadata(directory_path):
 
     metadata_items = {}
 
-    files_match = path.normpath(
-        '{root}/**/metadata.yaml'.format(root=directory_path)
-    )
-    files = glob(files_match, recursive=True)
+    files = list(scan_files(directory_path, filename='metadata.yaml'))
 
     if not files:
         raise EnvironmentError('No metadata.yaml files found')
@@ -132,30 +191,93 @@ def find_metadata(directory_path):
             directory = path.relpath(filedir, directory_path)
             metadata_items[directory] = {
                 'modified': path.getmtime(filepath),
-                'content': yaml.load(metadata_file.read()) or {}
+                'content': yaml.load(
+                    metadata_file.read(),
+                    Loader=SafeLoader
+                ) or {}
             }
 
     return metadata_items
 
 
+def load_template(template_path):
+    """
+    Read and compile a Jinja template, returning its source along with
+    the compiled template. The compiled template is reused for as long
+    as the file is unmodified.
+    """
+
+    return compile_template_file(
+        path.abspath(template_path),
+        path.getmtime(template_path)
+    )
+
+
+@lru_cache(maxsize=8)
+def compile_template_file(template_path, modified_time):
+    """
+    Compile a template file, cached by its path and modified time.
+    Compiled bytecode is also kept in the user cache directory,
+    if it can be written, so later runs can skip compiling
+    unchanged templates.
+    Only the template file itself is tracked, so templates should
+    be self-contained rather than including or extending others.
+    """
+
+    bytecode_cache = None
+
+    try:
+        bytecode_directory = path.join(
+            cache_dir('documentation-builder'),
+            'templates'
+        )
+        makedirs(bytecode_directory, exist_ok=True)
+    except OSError:
+        # No usable cache directory, so compile from source every time
+        pass
+    else:
+        if access(bytecode_directory, W_OK):
+            bytecode_cache = FileSystemBytecodeCache(bytecode_directory)
+
+    environment = Environment(
+        loader=FileSystemLoader(path.dirname(template_path)),
+        bytecode_cache=bytecode_cache,
+        auto_reload=False
+    )
+    template_name = path.basename(template_path)
+    template_source = environment.loader.get_source(
+        environment,
+        template_name
+    )[0]
+
+    return (template_source, environment.get_template(template_name))
+
+
 def parse_markdown(parser, template, filepath, metadata):
     parser.reset()
-    metadata = deepcopy(metadata)
+
+    # Only top-level keys are set below, so a shallow copy
+    # is enough to leave the caller's metadata untouched
+    metadata = dict(metadata)
 
     # Try to extract frontmatter metadata
     with open(filepath, encoding="utf-8") as markdown_file:
         file_content = markdown_file.read()
 
         try:
-            file_parts = frontmatter.loads(file_content)
-            metadata.update(file_parts.metadata)
-            metadata['content'] = parser.convert(file_parts.content)
+            if file_content.lstrip().startswith('---'):
+                file_parts = frontmatter.loads(file_content)
+                metadata.update(file_parts.metadata)
+                metadata['content'] = parser.convert(file_parts.content)
+            else:
+                # No frontmatter block at the top, so don't have frontmatter
+                # search the rest of the file for "---" lines to parse
+                metadata['content'] = parser.convert(file_content)
         except (ScannerError, ParserError):
             """
-            If there's a parsererror, it's because frontmatter had to parse
-            the entire file (not finding frontmatter at the top)
-            and encountered an unexpected format somewhere in it.
-            This means the file has no frontmatter, so we can simply continue.
+            If there's a parsererror, the file starts with "---" but
+            what follows isn't valid YAML frontmatter (e.g. it's
+            a horizontal rule), so treat the whole file as markdown.
             """
 
             metadata['content'] = parser.convert(file_content)
@@ -171,13 +293,16 @@ def parse_markdown(parser, template, filepath, metadata):
     # Now add on any multimarkdown-format metadata
     if hasattr(parser, 'Meta'):
         # Restructure markdown parser metadata to the same format as we expect
-        markdown_meta = parser.Meta
-
-        for name, value in markdown_meta.items():
-            if type(value) == list and len(value) == 1:
-                markdown_meta[name] = value[0]
-
-        metadata.update(markdown_meta)
+        metadata.update(
+            {
+                name: (
+                    value[0]
+                    if isinstance(value, list) and len(value) == 1
+                    else value
+                )
+                for name, value in parser.Meta.items()
+            }
+        )
 
     toc_soup = BeautifulSoup(parser.toc, 'html.parser')
 
@@ -207,6 +332,9 @@ def prepare_version_branches(base_directory, output_base):
     Otherwise, just return the base directory.
     """
 
+    # GitPython is slow to import and only needed for version branches
+    from git import Repo
+
     version_branches = {}
 
     with open(path.join(base_directory, 'versions')) as versions_file:
@@ -239,14 +367,35 @@ def prepare_version_branches(base_directory, output_base):
     return version_branches
 
 
+def read_build_hashes(hashes_filepath):
+    """
+    Read the hashes of previously built files, as saved by
+    write_build_hashes.
+    If they can't be read, return no hashes, so everything gets built.
+    """
+
+    if not path.isfile(hashes_filepath):
+        return {}
+
+    try:
+        with open(hashes_filepath, encoding="utf-8") as hashes_file:
+            build_hashes = json.load(hashes_file)
+    except (OSError, ValueError):
+        # An unreadable or corrupt hashes file means everything gets rebuilt
+        return {}
+
+    if not isinstance(build_hashes, dict):
+        return {}
+
+    return build_hashes
+
+
 def relativize_paths(item, original_base_path, new_base_path):
     """
     Recursively search a dictionary for items that look like local markdown
     locations, and replace them to be relative to local_dirpath instead
     """
 
-    internal_link_match = r'^[^ "\']+.md(#|\?|$)'
-
     original_base_path = original_base_path.strip('/')
     new_base_path = new_base_path.strip('/')
 
@@ -264,7 +413,7 @@ def relativize_paths(item, original_base_path, new_base_path):
                 original_base_path,
                 new_base_path
             )
-    elif isinstance(item, str) and re.match(internal_link_match, item):
+    elif isinstance(item, str) and markdown_location_match.match(item):
         item = relativize(
             item,
             original_base_path,
@@ -281,26 +430,57 @@ def replace_internal_links(html, extensions=True):
     or no extension otherwise
     """
 
-    internal_link_match = re.compile(
-        r'(?:(?<=src=["\'])|(?<=href=["\']))'
-        r'((?:[^ "\'/]|(?<![/"\'])/)+)\.md\b'
+    return replace_links(
+        html,
+        link_extension='.html' if extensions else ''
     )
 
-    # Replace internal document links
-    if extensions:
-        html = re.sub(
-            internal_link_match,
-            r'\1.html',
-            html
-        )
-    else:
-        html = re.sub(
-            internal_link_match,
-            r'\1',
-            html
-        )
 
-    return html
+def replace_links(
+    html,
+    old_media_path=None,
+    new_media_path=None,
+    context_directory='.',
+    link_extension='.html'
+):
+    """
+    Replace links to media with the new media location,
+    and internal links to .md files with link_extension
+    (or leave them alone if link_extension is None).
+    Both are done in a single pass over the document.
+    """
+
+    if old_media_path:
+        if not path.isabs(old_media_path):
+            old_media_path = path.relpath(old_media_path, context_directory)
+        if not path.isabs(new_media_path):
+            new_media_path = path.relpath(new_media_path, context_directory)
+
+        old_media_prefix = old_media_path + '/'
+    elif link_extension is None or '.md' not in html:
+        # Nothing could need replacing
+        return html
+
+    def replace_link(link_match):
+        link = link_match.group(0)
+
+        if old_media_path and link.startswith(old_media_prefix):
+            link = new_media_path + link[len(old_media_path):]
+
+        # Most links aren't to .md files, so check that before matching
+        if link_extension is not None and '.md' in link:
+            internal_link = internal_link_match.match(link)
+
+            if internal_link:
+                link = (
+                    internal_link.group(1) +
+                    link_extension +
+                    link[internal_link.end():]
+                )
+
+        return link
+
+    return link_value_match.sub(replace_link, html)
 
 
 def replace_media_links(
@@ -314,15 +494,13 @@ def replace_media_links(
     Do this intelligently relative to the current directory of the file.
     """
 
-    if old_path:
-        if not path.isabs(old_path):
-            old_path = path.relpath(old_path, context_directory)
-        if not path.isabs(new_path):
-            new_path = path.relpath(new_path, context_directory)
-
-        html = replace_link_paths(html, old_path, new_path)
-
-    return html
+    return replace_links(
+        html,
+        old_media_path=old_path,
+        new_media_path=new_path,
+        context_directory=context_directory,
+        link_extension=None
+    )
 
 
 def set_active_navigation_items(filename, items, parents=[]):
@@ -424,6 +602,30 @@ def convert_path_to_html(path):
     return path
 
 
+def write_build_hashes(build_hashes, hashes_filepath):
+    """
+    Save the hashes of built files, replacing the file in one step
+    so a concurrent build never reads a partial file.
+    Saving is only an optimisation for later builds, so return
+    False rather than failing if the file can't be written.
+    """
+
+    try:
+        with tempfile.NamedTemporaryFile(
+            mode="w",
+            encoding="utf-8",
+            dir=path.dirname(hashes_filepath) or path.curdir,
+            delete=False
+        ) as hashes_file:
+            json.dump(build_hashes, hashes_file)
+
+        replace(hashes_file.name, hashes_filepath)
+    except OSError:
+        return False
+
+    return True
+
+
 def write_html(html, output_filepath):
 
     """
@@ -436,9 +638,20 @@ def write_html(html, output_filepath):
 
     makedirs(output_dir, exist_ok=True)
 
-    with open(
-        output_filepath, mode="w", encoding="utf-8"
-    ) as output_file:
-        output_file.write(html)
+    html_bytes = html.encode('utf-8')
+
+    # If the file already has this content, just mark it as updated
+    if (
+        path.isfile(output_filepath) and
+        path.getsize(output_filepath) == len(html_bytes)
+    ):
+        with open(output_filepath, mode="rb") as output_file:
+            if output_file.read() == html_bytes:
+                utime(output_filepath)
+
+                return output_filepath
+
+    with open(output_filepath, mode="wb") as output_file:
+        output_file.write(html_bytes)
 
     return output_filepath
@@ -1,29 +1,36 @@
 # Core modules
-import re
-from os import environ, listdir, makedirs, path, stat
+from os import environ, makedirs, path, scandir, stat
 from shutil import copy2
 
 
 def mergetree(src, dst, symlinks=False, ignore=None):
     """
-    Deep-merge two directory trees, overwriting changed files
+    Deep-merge two directory trees, copying only files which are
+    missing from dst, or which have changed size or been modified since
     """
 
     if not path.isdir(src):
         raise EnvironmentError('Source tree not found: ' + src)
 
     makedirs(dst, exist_ok=True)
-    for item in listdir(src):
-        source = path.join(src, item)
-        destination = path.join(dst, item)
-        if path.isdir(source):
-            mergetree(source, destination, symlinks, ignore)
+    for entry in scandir(src):
+        destination = path.join(dst, entry.name)
+        if entry.is_dir():
+            mergetree(entry.path, destination, symlinks, ignore)
         else:
+            source_stat = entry.stat()
+
+            try:
+                destination_stat = stat(destination)
+            except FileNotFoundError:
+                destination_stat = None
+
             if (
-                not path.exists(destination) or
-                stat(source).st_mtime - stat(destination).st_mtime > 1
+                not destination_stat or
+                source_stat.st_size != destination_stat.st_size or
+                source_stat.st_mtime - destination_stat.st_mtime > 1
             ):
-                copy2(source, destination)
+                copy2(entry.path, destination)
 
 
 def relativize(location, original_base_path, new_base_path):
@@ -40,37 +47,73 @@ def relativize(location, original_base_path, new_base_path):
     return path.relpath(abs_location, abs_dirpath)
 
 
-def replace_link_paths(html, old_link_path, new_link_path):
+def matching_metadata(metadata_items, context_path):
     """
-    In some HTML text, replace old link paths with a new path
+    Given a list of metadata items, keyed by normalised relative
+    directory paths (as returned by find_metadata), and a directory path,
+    return only the items which relate to that path,
+    from the outermost directory inwards
     """
 
-    link_search = r'((?<=src=["\'])|(?<=href=["\'])){}(?=/)'.format(
-        old_link_path.replace('.', '\.')
-    )
+    # Look up the context directory and each of its parents
+    context_path = path.normpath(context_path)
+    ancestors = [path.curdir]
 
-    return re.sub(link_search, new_link_path, html)
+    if context_path != path.curdir:
+        parts = context_path.split(path.sep)
+        ancestors.extend(
+            path.join(*parts[:depth]) for depth in range(1, len(parts) + 1)
+        )
 
+    for ancestor in ancestors:
+        if ancestor in metadata_items:
+            yield (ancestor, metadata_items[ancestor])
 
-def matching_metadata(metadata_items, context_path):
+
+def scan_files(directory_path, extension='', filename=None):
     """
-    Given a list of metadata items and a directory path,
-    return only the items which relate to that path
+    Find all files inside a directory, recursively, which end with
+    extension (or are called filename, if given).
+    Like a recursive glob for "**/*.md", hidden files and folders are
+    skipped, but this avoids matching every path against a pattern.
     """
 
-    for dirpath, item in sorted(
-        metadata_items.items(), key=sort_paths
-    ):
-        if '..' not in path.relpath(context_path, dirpath):
-            yield (dirpath, item)
+    root = path.normpath(directory_path)
 
+    if root == path.curdir:
+        root = ''
 
-def sort_paths(item):
-    """
-    Sort key for metadata items to normalise paths
-    """
+    if not path.isdir(root or path.curdir):
+        return
+
+    directories = [root]
+
+    while directories:
+        directory = directories.pop()
+        subdirectories = []
+
+        try:
+            entries = list(scandir(directory or path.curdir))
+        except OSError:
+            # Like glob, skip directories which can't be read
+            continue
+
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+
+            entry_path = path.join(directory, entry.name)
+
+            if entry.is_dir():
+                subdirectories.append(entry_path)
+            elif (
+                entry.name == filename if filename
+                else entry.name.endswith(extension)
+            ):
+                yield entry_path
 
-    return path.normpath(item[0])
+        # Visit subdirectories in order, depth-first
+        directories.extend(reversed(subdirectories))
 
 
 def cache_dir(name):